@@ -2,60 +2,105 @@
 
 import sys
 import time
-import toml
 import dacite
 import typing
+import logging
 import sqlite3
 import pathlib
 import requests
-import datetime
 import schedule
+import functools
 import dataclasses
 
+try:
+    import orjson as json
+except ImportError:
+    import json
 
-def info(message):
-    if sys.stdout.isatty():
-        print(f"\033[1m[\033[32minfo\033[0;1m]\033[0m {message}",
-              file=sys.stderr)
-    else:
-        print(f"[info] {message}", file=sys.stderr)
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
 
 
-def error_message(message):
-    if sys.stdout.isatty():
-        print(f"\033[1m[\033[31merror\033[0;1m]\033[0m {message}",
-              file=sys.stderr)
-    else:
-        print(f"[error] {message}", file=sys.stderr)
+class LevelFormatter(logging.Formatter):
+    def __init__(self, formats: dict[int, str], default: str):
+        super().__init__()
+        self.formatters = {level: logging.Formatter(fmt)
+                           for level, fmt in formats.items()}
+        self.default = logging.Formatter(default)
+
+    def format(self, record: logging.LogRecord) -> str:
+        return self.formatters.get(record.levelno, self.default).format(record)
+
+
+logger = logging.getLogger("sql-mts-k")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler(sys.stderr)
+if sys.stdout.isatty():
+    handler.setFormatter(LevelFormatter({
+        logging.INFO: "\033[1m[\033[32minfo\033[0;1m]\033[0m %(message)s",
+        logging.ERROR: "\033[1m[\033[31merror\033[0;1m]\033[0m %(message)s",
+    }, "\033[1m[%(levelname)s]\033[0m %(message)s"))
+else:
+    handler.setFormatter(LevelFormatter({
+        logging.INFO: "[info] %(message)s",
+        logging.ERROR: "[error] %(message)s",
+    }, "[%(levelname)s] %(message)s"))
+logger.addHandler(handler)
 
 
 def error(message):
-    error_message(message)
+    logger.error(message)
     exit(1)
 
 
-def sqlite3_insert_dataclass(cursor: sqlite3.Cursor,
-                             table_name: str,
-                             dataclass: typing.Any,
-                             or_ignore: bool = False):
+@functools.lru_cache
+def sqlite3_insert_statement(table_name: str,
+                             dataclass: type,
+                             or_ignore: bool,
+                             upsert_key: str | None = None
+                             ) -> tuple[str, tuple[str, ...]]:
+    field_names = tuple([field.name for field in dataclasses.fields(dataclass)])
+    columns = ','.join(field_names)
+    params = ','.join(['?'] * len(field_names))
+
+    string = f"INSERT {'OR IGNORE' if or_ignore else ''} \
+               INTO {table_name} ({columns}) VALUES ({params})"
+
+    if upsert_key is not None:
+        updates = ','.join([f"{name}=excluded.{name}"
+                            for name in field_names if name != upsert_key])
+        string += f" ON CONFLICT ({upsert_key}) DO UPDATE SET {updates}"
+
+    return string + ";", field_names
+
+
+def sqlite3_insert_dataclasses_many(cursor: sqlite3.Cursor,
+                                    table_name: str,
+                                    dataclass: typing.Any,
+                                    rows: typing.Iterable[typing.Any],
+                                    or_ignore: bool = False,
+                                    upsert_key: str | None = None):
     if not dataclasses.is_dataclass(dataclass):
         raise ValueError()
 
-    fields = dataclasses.fields(dataclass)
-    row = tuple([getattr(dataclass, field.name) for field in fields])
-    columns = ','.join([field.name for field in fields])
-    params = ','.join(['?'] * len(fields))
-
-    string = f"INSERT {'OR IGNORE' if or_ignore else ''} \
-               INTO {table_name} ({columns}) VALUES ({params});"
-    cursor.execute(string, row)
+    string, field_names = sqlite3_insert_statement(table_name,
+                                                   dataclass,
+                                                   or_ignore,
+                                                   upsert_key)
+    cursor.executemany(string, [
+        tuple([getattr(row, name) for name in field_names]) for row in rows
+    ])
 
 
 def sqlite3_create_table_for_dataclass(cursor: sqlite3.Cursor,
                                        table_name: str,
                                        dataclass: typing.Any,
                                        primary_key: None | str | tuple[str, ...] = None,
-                                       if_not_exists: bool = False):
+                                       if_not_exists: bool = False,
+                                       without_rowid: bool = False):
     if not dataclasses.is_dataclass(dataclass):
         raise ValueError()
 
@@ -63,9 +108,7 @@ def sqlite3_create_table_for_dataclass(cursor: sqlite3.Cursor,
     field_names = [field.name for field in fields]
 
     if isinstance(primary_key, str):
-        if at := field_names.index(primary_key) < 0:
-            raise ValueError()
-
+        at = field_names.index(primary_key)
         field_names[at] += " PRIMARY KEY"
 
     if isinstance(primary_key, tuple):
@@ -74,11 +117,12 @@ def sqlite3_create_table_for_dataclass(cursor: sqlite3.Cursor,
     columns = ','.join(field_names)
 
     string = f"CREATE TABLE {'IF NOT EXISTS' if if_not_exists else ''} \
-               {table_name} ({columns});"
+               {table_name} ({columns}) \
+               {'WITHOUT ROWID' if without_rowid else ''};"
     cursor.execute(string)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class SqlStatus():
     stationId: str
     isOpen: bool
@@ -90,6 +134,10 @@ class SqlMtsKConfig():
     timeout: int = 10
     interval: int = 360
     database_path: str = "/etc/sql-mts-k.db"
+    journal_mode: typing.Literal['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY',
+                                 'WAL', 'OFF'] = "WAL"
+    synchronous: typing.Literal['OFF', 'NORMAL', 'FULL', 'EXTRA'] = "NORMAL"
+    oneshot: bool = False
 
 
 @dataclasses.dataclass
@@ -109,11 +157,13 @@ class Config():
 
     @staticmethod
     def from_file(filepath: pathlib.Path | str) -> 'Config':
-        data = toml.loads(open(filepath).read())
+        with open(filepath, 'rb') as f:
+            data = tomllib.load(f)
+
         return dacite.from_dict(data_class=Config, data=data)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class SqlStation():
     id: str
     name: str
@@ -127,14 +177,14 @@ class SqlStation():
     postCode: int
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class SqlPrice():
     stationId: str
     timestamp: int
     price: float
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class TankerkoenigStation():
     id: str
     name: str
@@ -149,6 +199,21 @@ class TankerkoenigStation():
     houseNumber: str
     postCode: int
 
+    @staticmethod
+    def from_dict(data: dict[str, typing.Any]) -> 'TankerkoenigStation':
+        return TankerkoenigStation(data["id"],
+                                   data["name"],
+                                   data["brand"],
+                                   data["street"],
+                                   data["place"],
+                                   data["lat"],
+                                   data["lng"],
+                                   data["dist"],
+                                   data.get("price"),
+                                   data["isOpen"],
+                                   data["houseNumber"],
+                                   data["postCode"])
+
 
 @dataclasses.dataclass
 class TankerkoenigListResponse():
@@ -157,83 +222,147 @@ class TankerkoenigListResponse():
     message: typing.Optional[str]
     stations: typing.Optional[list[TankerkoenigStation]]
 
+    @staticmethod
+    def from_dict(data: dict[str, typing.Any]) -> 'TankerkoenigListResponse':
+        stations = data.get("stations")
+        if stations is not None:
+            stations = [TankerkoenigStation.from_dict(station)
+                        for station in stations]
+
+        return TankerkoenigListResponse(data["ok"],
+                                        data["status"],
+                                        data.get("message"),
+                                        stations)
+
     def insert_into_database(self,
                              cursor: sqlite3.Cursor,
-                             timestamp: int | None = None):
+                             timestamp: int | None = None,
+                             known_station_ids: set[str] | None = None):
         assert self.stations is not None
 
+        if known_station_ids is None:
+            known_station_ids = set()
+
         if timestamp is None:
-            now = datetime.datetime.now()
-            timestamp = round(datetime.datetime.timestamp(now))
+            timestamp = round(time.time())
+
+        stations_rows: list[SqlStation] = []
+        status_rows: list[SqlStatus] = []
+        prices_rows: list[SqlPrice] = []
 
         for station in self.stations:
-            sql_station = SqlStation(station.id,
-                                     station.name,
-                                     station.brand,
-                                     station.street,
-                                     station.place,
-                                     station.lat,
-                                     station.lng,
-                                     station.dist,
-                                     station.houseNumber,
-                                     station.postCode)
-
-            if station.price is None:
-                continue
-
-            sql_status = SqlStatus(station.id, station.isOpen)
-            sql_price = SqlPrice(station.id, timestamp, station.price)
-
-            sqlite3_insert_dataclass(cursor,
-                                     'stations',
-                                     sql_station,
-                                     or_ignore=True)
-
-            sqlite3_insert_dataclass(cursor,
-                                     'status',
-                                     sql_status,
-                                     or_ignore=True)
-
-            sqlite3_insert_dataclass(cursor,
-                                     'prices',
-                                     sql_price,
-                                     or_ignore=True)
+            if station.price is not None:
+                if station.id not in known_station_ids:
+                    stations_rows.append(SqlStation(station.id,
+                                                    station.name,
+                                                    station.brand,
+                                                    station.street,
+                                                    station.place,
+                                                    station.lat,
+                                                    station.lng,
+                                                    station.dist,
+                                                    station.houseNumber,
+                                                    station.postCode))
+                    known_station_ids.add(station.id)
+
+                prices_rows.append(SqlPrice(station.id,
+                                            timestamp,
+                                            station.price))
+
+            # Stations without a price are usually closed, so their status is
+            # still updated, but only if they are already in `stations`.
+            if station.id in known_station_ids:
+                status_rows.append(SqlStatus(station.id, station.isOpen))
+
+        sqlite3_insert_dataclasses_many(cursor,
+                                        'stations',
+                                        SqlStation,
+                                        stations_rows,
+                                        or_ignore=True)
+
+        sqlite3_insert_dataclasses_many(cursor,
+                                        'status',
+                                        SqlStatus,
+                                        status_rows,
+                                        upsert_key='stationId')
+
+        sqlite3_insert_dataclasses_many(cursor,
+                                        'prices',
+                                        SqlPrice,
+                                        prices_rows,
+                                        or_ignore=True)
 
 
 CONFIG_PATH = "/etc/sql-mts-k.toml"
+MAX_RETRY_TIMEOUT = 60
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
 
 tankerkoenig_params: dict[str, typing.Any]
 sql_mts_k= SqlMtsKConfig()
 con: sqlite3.Connection
 cur: sqlite3.Cursor
+known_station_ids: set[str]
+
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1,
+                                                       pool_maxsize=1,
+                                                       max_retries=0))
 
 
-def fetch_current_prices():
-    global sql_mts_k, tankernoenig_params, con, cur
+def retry_timeout(timeout: int, attempt: int) -> int:
+    return min(timeout * (2 ** attempt), max(timeout, MAX_RETRY_TIMEOUT))
 
+
+def request_current_prices() -> dict[str, typing.Any] | None:
     url = "https://creativecommons.tankerkoenig.de/json/list.php"
 
     for i in range(0, sql_mts_k.tries):
-        response = requests.get(url=url, params=tankerkoenig_params)
-        if response.status_code == 200:
-            break
-
-        error_message(f"Retrying {i+1}/{sql_mts_k.tries}")
-        time.sleep(sql_mts_k.timeout)
+        try:
+            response = session.get(url, params=tankerkoenig_params,
+                                   timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request failed: {str(e)}")
+        else:
+            if response.ok:
+                break
+
+            if response.status_code < 500:
+                logger.error(f"Request failed with {response.status_code}")
+                return None
+
+            logger.error(f"Server responded with {response.status_code}")
+
+        if i + 1 < sql_mts_k.tries:
+            logger.error(f"Retrying {i+1}/{sql_mts_k.tries}")
+            time.sleep(retry_timeout(sql_mts_k.timeout, i))
     else:
-        error_message(f"Unable to fetch after {sql_mts_k.tries} tries")
-        return
+        logger.error(f"Unable to fetch after {sql_mts_k.tries} tries")
+        return None
+
+    try:
+        return json.loads(response.content)
+    except ValueError as e:
+        logger.error(f"Unable to decode response: {str(e)}")
+        return None
 
-    data = dacite.from_dict(data_class=TankerkoenigListResponse,
-                            data=response.json())
+
+def fetch_current_prices() -> bool:
+    response = request_current_prices()
+    if response is None:
+        return False
+
+    data = TankerkoenigListResponse.from_dict(response)
 
     if not data.ok:
-        error_message(data.message)
+        logger.error(data.message)
+        return False
 
-    data.insert_into_database(cur)
-    con.commit()
+    with con:
+        data.insert_into_database(cur, known_station_ids=known_station_ids)
 
-    info("Successfully fetched the current prices")
+    logger.info("Successfully fetched the current prices")
+    return True
 
 
 try:
@@ -247,11 +376,18 @@ try:
     # "Home-Automation-, Smart-Mirror- und ähnliche Systeme sollten Abfragen
     # nicht öfter als einmal in 5 Minuten durchführen"
     #
-    # If every retry fails, it takes roughly (TRIES * RETRY_TIMEOUT) seconds.
-    # Since the task took a long time to complete, schedule will then
-    # reschedule it earlier.
-    if sql_mts_k.interval < (5*60) + (sql_mts_k.tries * sql_mts_k.timeout):
-        raise Exception("`interval-tries*timeout` must be greater than 5 min")
+    # If every retry fails, it takes roughly the sum of all backoff delays,
+    # plus up to CONNECT_TIMEOUT + READ_TIMEOUT per try for stalled requests.
+    # Only the backoff is checked here, as READ_TIMEOUT limits the time
+    # between bytes rather than the whole request. Since the task took a long
+    # time to complete, schedule will then reschedule it earlier.
+    #
+    # In oneshot mode the interval is left to whatever starts the script.
+    backoff = sum([retry_timeout(sql_mts_k.timeout, i)
+                   for i in range(0, sql_mts_k.tries - 1)])
+    if not sql_mts_k.oneshot and sql_mts_k.interval < (5*60) + backoff:
+        raise Exception("`interval` minus the retry backoff must be greater \
+than 5 min")
 
 except Exception as e:
     error(f"Unable to load config: {str(e)}")
@@ -259,6 +395,11 @@ except Exception as e:
 con = sqlite3.connect(sql_mts_k.database_path)
 cur = con.cursor()
 
+cur.execute(f"PRAGMA journal_mode={sql_mts_k.journal_mode};")
+cur.execute(f"PRAGMA synchronous={sql_mts_k.synchronous};")
+cur.execute("PRAGMA temp_store=MEMORY;")
+cur.execute("PRAGMA cache_size=-8000;")
+
 sqlite3_create_table_for_dataclass(cur,
                                    'stations',
                                    SqlStation,
@@ -268,16 +409,28 @@ sqlite3_create_table_for_dataclass(cur,
                                    'prices',
                                    SqlPrice,
                                    primary_key=('stationId', 'timestamp'),
-                                   if_not_exists=True)
+                                   if_not_exists=True,
+                                   without_rowid=True)
 sqlite3_create_table_for_dataclass(cur,
                                    'status',
                                    SqlStatus,
-                                   primary_key=('stationId'),
-                                   if_not_exists=True)
+                                   primary_key='stationId',
+                                   if_not_exists=True,
+                                   without_rowid=True)
 
-schedule.every(sql_mts_k.interval).seconds.do(fetch_current_prices)
+cur.execute("CREATE INDEX IF NOT EXISTS idx_prices_timestamp \
+             ON prices (timestamp);")
+
+known_station_ids = set([row[0]
+                         for row in cur.execute("SELECT id FROM stations;")])
+
+logger.info("Initialization successful")
 
-info("Initialization successful")
+# Fetch once and exit, leaving the scheduling to e.g. a systemd timer.
+if sql_mts_k.oneshot:
+    exit(0 if fetch_current_prices() else 1)
+
+schedule.every(sql_mts_k.interval).seconds.do(fetch_current_prices)
 
 while True:
     seconds_until_next_run = schedule.idle_seconds()